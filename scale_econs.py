@@ -76,31 +76,20 @@ t = np.vstack((sm, sf)).T
 for i in TYPE:
     t = np.hstack((t, np.where(shs_data[f'z{i}'] == 1, 1, 0)[:, None]))
 
-gt = pd.DataFrame(
-    (g.values[:, None] * t[..., None]).reshape(shs_data.shape[0], -1)
-    )
-gt_excluded = [i for i in range(gt.shape[1]) if gt[i].sum() == 1]
-idx_excluded = [
-    gt.index[
-        gt[gt_excluded[i]] == 1
-        ].tolist()[0] for i in range(len(gt_excluded))
-        ]
-
-shs_data = shs_data.drop(idx_excluded).reset_index(drop=True)
-g = g.drop(idx_excluded).reset_index(drop=True)
-t = np.delete(t, idx_excluded, 0)
+# Each observation falls in exactly one group and one type, so locate its 
+# group-type cell directly rather than forming the N*(G*T) indicators.
+gt = t.argmax(axis=1) * g.shape[1] + g.values.argmax(axis=1)
+keep = np.bincount(gt)[gt] > 1
+
+shs_data = shs_data[keep].reset_index(drop=True)
+g = g[keep].reset_index(drop=True)
+t = t[keep]
 NAME_t = ['sm', 'sf'] + [f'h{i+1}' for i in range(len(TYPE))]
 t_single = np.hstack(((t[:, 0] + t[:, 1])[:, None], t[:, 2:]))
 NAME_t_single = ['s'] + [f'h{i+1}' for i in range(len(TYPE))]
 
-gt = scipy.sparse.csr_array(
-    gt.drop(idx_excluded).reset_index(drop=True).values
-    ).nonzero()
-clusters = np.array(
-    [[
-        int(g.columns[g.iloc[i].isin([1.0])][0].replace('g', ''))
-        ] for i in range(g.shape[0])]
-    )
+gt = (np.arange(t.shape[0]), gt[keep])
+clusters = (g.values.argmax(axis=1) + 1)[:, None]
 
 
 # Create variables.
@@ -113,9 +102,9 @@ def demean(var, gt):
         An N*P NumPy array of the sample where N is the number of observations  
         and P is the number of variables.
     gt:
-        A sparse matrix of group indicators generated by the function 
-        scipy.sparse.csr_array(matrix). The input matrix must be an N*G matrix 
-        where N is the number of observations and G is the number of groups.
+        A tuple (row, group) of integer arrays locating the group of each 
+        observation, e.g. (np.arange(N), g.argmax(axis=1)) for an N*G matrix 
+        g of one-hot group indicators.
 
     Outputs:
     --------
@@ -125,9 +114,18 @@ def demean(var, gt):
     """
     var_demean = np.zeros((var.shape[0], var.shape[1]))
 
-    for i in np.unique(gt[1]):
-        index = gt[0][np.where(gt[1] == i)]
-        var_demean[index, :] = var[index, :] - var[index, :].mean(axis=0)
+    # Sort observations by group so that each group is a contiguous block, 
+    # then sum within blocks in a single pass.
+    order = np.argsort(gt[1], kind='stable')
+    groups_sorted = gt[1][order]
+    rows_sorted = gt[0][order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(groups_sorted)) + 1))
+    sizes = np.diff(np.append(starts, len(groups_sorted)))
+
+    var_sorted = np.asarray(var[rows_sorted, :], dtype=float)
+    means = np.add.reduceat(var_sorted, starts, axis=0) / sizes[:, None]
+    var_sorted -= np.repeat(means, sizes, axis=0)
+    var_demean[rows_sorted, :] = var_sorted
     
     return var_demean
 
@@ -323,8 +321,8 @@ def cov_to_cor(cov):
     cor:
         A 2-d NumPy array of correlation matrix.
     """
-    v = np.sqrt(np.diag(cov))
-    cor = cov / np.outer(v, v)
+    inv_v = 1 / np.sqrt(np.diag(cov))
+    cor = cov * inv_v[:, None] * inv_v[None, :]
 
     return cor
 
@@ -345,8 +343,8 @@ for tt in range(len(TYPE)):
     g_bery_included = [
         f'{i}_{j}' for i in g_included for j in NAME_bery_crosssum
         ]
-    g_new = scipy.sparse.csr_array(res_data[NAME_g].values)
-    g_new = g_new.nonzero()
+    g_new = (np.arange(res_data.shape[0]), 
+             res_data[NAME_g].values.argmax(axis=1))
     res_data = pd.DataFrame(demean(res_data.values, g_new), 
                             columns=res_data.columns)
     
@@ -361,6 +359,8 @@ for tt in range(len(TYPE)):
         
         cv = RepeatedKFold(random_state=123)
         penalty = np.array([1.0]*(exog.shape[1]-1) + [0.0])
+        exog_np = exog.to_numpy()
+        dep_np = dep.to_numpy()
 
         lasso_model = CustomENetCV(
             cv=cv, 
@@ -369,21 +369,21 @@ for tt in range(len(TYPE)):
             verbose=False, 
             max_iter=10000
             )
-        lasso_model.fit(exog.to_numpy(), dep.to_numpy(), s=penalty)
+        lasso_model.fit(exog_np, dep_np, s=penalty)
 
         lasso_lrobust = CustomENet(
             lasso_model.alpha_best*0.5, 
             l1_ratio=1, 
             fit_intercept=False
             )
-        lasso_lrobust.fit(exog.to_numpy(), dep.to_numpy(), s=penalty)
+        lasso_lrobust.fit(exog_np, dep_np, s=penalty)
 
         lasso_urobust = CustomENet(
             lasso_model.alpha_best*2, 
             l1_ratio=1, 
             fit_intercept=False
             )
-        lasso_urobust.fit(exog.to_numpy(), dep.to_numpy(), s=penalty)
+        lasso_urobust.fit(exog_np, dep_np, s=penalty)
 
         exog_selected = exog[exog.columns[np.nonzero(lasso_model.w)[0]]]
         exog_lrobust = exog[exog.columns[np.nonzero(lasso_lrobust.w)[0]]]
@@ -629,8 +629,10 @@ def scale(barten, cov, cov_se, data, single_indicator, TYPE, NAME_w):
         A dataframe for the household-level scale economies indices under 
         different household types.
     """
-    w_bar = data[single_indicator == 1, :].mean(axis=0)
-    w_cov = pd.DataFrame(data[single_indicator == 1, :]).cov().values
+    data_s = data[single_indicator == 1, :]
+    w_bar = data_s.mean(axis=0)
+    data_c = data_s - w_bar
+    w_cov = data_c.T @ data_c / (data_c.shape[0] - 1)
     scales = pd.DataFrame(
         index=["mean", "mean_se", "sd"], 
         columns=[f"h{i+1}" for i in range(len(TYPE))]
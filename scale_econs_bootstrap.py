@@ -9,9 +9,8 @@ import numpy as np
 import pandas as pd
 
 from multiprocessing import Pool
-from scipy.sparse import csr_array
-from linearmodels.system import SUR
-from collections import OrderedDict
+from multiprocessing.shared_memory import SharedMemory
+from numba import njit
 from tqdm import tqdm
 
 from bocpdms.nearestPD import NPD # Borrowed from https://github.com/alan-turing-institute/bocpdms.git
@@ -27,9 +26,9 @@ def demean(var, gt):
         An N*P NumPy array of the sample where N is the number of observations  
         and P is the number of variables.
     gt:
-        A sparse matrix of group indicators generated by the function 
-        scipy.sparse.csr_array(matrix). The input matrix must be an N*G matrix 
-        where N is the number of observations and G is the number of groups.
+        A tuple (row, group) of integer arrays locating the group of each 
+        observation, e.g. (np.arange(N), g.argmax(axis=1)) for an N*G matrix 
+        g of one-hot group indicators.
 
     Outputs:
     --------
@@ -37,14 +36,189 @@ def demean(var, gt):
         An N*P NumPy array of the demeaned sample where N is the number of      
         observations and P is the number of variables.
     """
-    var_demean = np.zeros((var.shape[0], var.shape[1]))
-
-    for i in np.unique(gt[1]):
-        index = gt[0][np.where(gt[1] == i)]
-        var_demean[index, :] = var[index, :] - var[index, :].mean(axis=0)
+    var_demean = demean_nb(
+        np.ascontiguousarray(var, dtype=np.float64), 
+        np.asarray(gt[0], dtype=np.int64), 
+        np.asarray(gt[1], dtype=np.int64), 
+        int(gt[1].max()) + 1
+        )
     
     return var_demean
 
+@njit(cache=True)
+def demean_nb(var, row_idx, grp_idx, num_groups):
+    """Compiled kernel of demean(). Group sums are accumulated in one pass, 
+    then the group means are subtracted in a second."""
+    sums = np.zeros((num_groups, var.shape[1]))
+    counts = np.zeros(num_groups)
+    for k in range(row_idx.shape[0]):
+        counts[grp_idx[k]] += 1
+        sums[grp_idx[k], :] += var[row_idx[k], :]
+
+    var_demean = np.zeros(var.shape)
+    for k in range(row_idx.shape[0]):
+        for p in range(var.shape[1]):
+            var_demean[row_idx[k], p] = (var[row_idx[k], p] 
+                                         - sums[grp_idx[k], p] 
+                                         / counts[grp_idx[k]])
+
+    return var_demean
+
+@njit(cache=True)
+def triu_prod_nb(var, iu, ju):
+    """Return the N*len(iu) array of column products var[:, iu]*var[:, ju]."""
+    out = np.empty((var.shape[0], iu.shape[0]))
+    for n in range(var.shape[0]):
+        for p in range(iu.shape[0]):
+            out[n, p] = var[n, iu[p]] * var[n, ju[p]]
+
+    return out
+
+@njit(cache=True)
+def triu_sum_nb(var, iu, ju):
+    """Return the N*len(iu) array of column sums var[:, iu]+var[:, ju]."""
+    out = np.empty((var.shape[0], iu.shape[0]))
+    for n in range(var.shape[0]):
+        for p in range(iu.shape[0]):
+            out[n, p] = var[n, iu[p]] + var[n, ju[p]]
+
+    return out
+
+def sur(dep, exog, names):
+    """Estimate a system of seemingly unrelated regressions by feasible GLS. 
+    The estimates equal those of linearmodels.system.SUR.fit() with 
+    cov_type="unadjusted", but are computed from NumPy arrays directly.
+
+    Parameters:
+    -----------
+    dep:
+        An N*K NumPy array of the dependent variables where N is the number of 
+        observations and K is the number of equations.
+    exog:
+        A list of K NumPy arrays of the regressors, one N*P_k array for each 
+        equation.
+    names:
+        A list of K lists of the regressor names, one for each equation.
+
+    Outputs:
+    --------
+    params:
+        A pandas Series of the estimated parameters, indexed by 'eq{k}_{name}' 
+        as in linearmodels.
+    """
+    eq = np.repeat(np.arange(len(exog)), [x_k.shape[1] for x_k in exog])
+
+    # One symmetric product of the regressors stacked with the dependent 
+    # variables, which NumPy evaluates with syrk, gives both X'X and X'y.
+    xy = np.hstack(exog + [dep])
+    gram = xy.T @ xy
+    xpx = gram[:eq.shape[0], :eq.shape[0]]
+    xpy = gram[:eq.shape[0], eq.shape[0]:]
+
+    # Equation-by-equation OLS gives the residual covariance matrix.
+    beta = np.concatenate([
+        np.linalg.solve(xpx[np.ix_(eq == k, eq == k)], xpy[eq == k, k]) 
+        for k in range(len(exog))
+        ])
+    eps = dep - np.column_stack(
+        [exog[k] @ beta[eq == k] for k in range(len(exog))]
+        )
+    sigma_inv = np.linalg.inv(eps.T @ eps / dep.shape[0])
+
+    # GLS on the stacked system.
+    beta = np.linalg.solve(
+        xpx * sigma_inv[eq][:, eq], 
+        (xpy @ sigma_inv)[np.arange(eq.shape[0]), eq]
+        )
+
+    return pd.Series(
+        beta, 
+        index=[f'eq{k+1}_{name}' 
+               for k in range(len(names)) for name in names[k]]
+        )
+
+def group_exog(cols, NAME_exog, group, bery_prod, bery_sum):
+    """Assemble the demeaned regressors of a Barten scale variance equation. 
+    Demeaning within groups maps a group-by-crosssum interaction to the group 
+    indicator times the demeaned crosssum, so only the selected columns are 
+    formed instead of all G*P interactions.
+
+    Parameters:
+    -----------
+    cols:
+        A list of the regressor names of the equation.
+    NAME_exog:
+        A pandas Index of all candidate regressor names: the P crossproducts, 
+        followed by the G*P group-by-crosssum interactions ordered by group.
+    group:
+        A NumPy array of length N of the group of each observation.
+    bery_prod:
+        An N*P NumPy array of the demeaned crossproducts.
+    bery_sum:
+        An N*P NumPy array of the demeaned crosssums.
+
+    Outputs:
+    --------
+    exog:
+        An N*len(cols) NumPy array of the regressors.
+    """
+    pos = NAME_exog.get_indexer(cols)
+    prod = pos < bery_prod.shape[1]
+    k, j = np.divmod(pos[~prod] - bery_prod.shape[1], bery_prod.shape[1])
+    exog = np.empty((group.shape[0], pos.shape[0]))
+    exog[:, prod] = bery_prod[:, pos[prod]]
+    exog[:, ~prod] = (group[:, None] == k) * bery_sum[:, j]
+
+    return exog
+
+def sym_from_upper(vec, iu, ju):
+    """Build a symmetric matrix from its upper triangle.
+
+    Parameters:
+    -----------
+    vec:
+        A NumPy array of the upper-triangular entries, ordered as (iu, ju).
+    iu, ju:
+        The row and column indices returned by np.triu_indices(K, k=0).
+
+    Outputs:
+    --------
+    matrix:
+        A K*K symmetric NumPy array.
+    """
+    matrix = np.empty((iu[-1] + 1, iu[-1] + 1))
+    matrix[iu, ju] = vec
+    matrix[ju, iu] = vec
+
+    return matrix
+
+def nearest_pd(matrix, eps=1e-12):
+    """Project a symmetric matrix onto the positive definite matrices by 
+    clipping its eigenvalues at eps. For a small matrix this is one eigh call, 
+    and NPD.nearestPD is only used if the result still fails a Cholesky test.
+
+    Parameters:
+    -----------
+    matrix:
+        A K*K symmetric NumPy array.
+    eps:
+        The smallest eigenvalue allowed in the result.
+
+    Outputs:
+    --------
+    matrix_pd:
+        A K*K positive definite NumPy array.
+    """
+    eigval, eigvec = np.linalg.eigh((matrix + matrix.T) / 2)
+    matrix_pd = (eigvec * np.clip(eigval, eps, None)) @ eigvec.T
+
+    try:
+        np.linalg.cholesky(matrix_pd)
+    except np.linalg.LinAlgError:
+        matrix_pd = NPD.nearestPD(matrix)
+
+    return matrix_pd
+
 def bootstrap(
         resampling, 
         shs_data, 
@@ -53,236 +227,174 @@ def bootstrap(
         SHAREABLE=(1, 2, 8, 17, 19), 
         NONSHAREABLE=6, 
         DEMOG=(1, 2)):
-    # Generate a bootstrap sample.
-    shs_data = pd.DataFrame(
-        shs_data, 
-        columns=([f's{i}' for i in SHAREABLE] 
-                 + [f's{NONSHAREABLE}'] 
-                 + [f'p{i}' for i in SHAREABLE] 
-                 + [f'p{NONSHAREABLE}'] 
-                 + ['x'] 
-                 + [f'z{i}' for i in DEMOG] 
-                 + [f'z{i}' for i in (3, 23)] 
-                 + [f'z{i}' for i in TYPE] 
-                 + [f'z{i}' for i in range(29, 51)])
-        )
-    shs_data = shs_data.loc[resampling]
+    # Generate a bootstrap sample by gathering the precomputed variables.
+    w_all, y, er, z, t, g = np.split(
+        shs_data[resampling], 
+        np.cumsum([len(SHAREABLE) + 1, 
+                   1, 
+                   len(SHAREABLE), 
+                   len(DEMOG), 
+                   len(TYPE) + 2]), 
+        axis=1)
 
 
     # Setup groups (province-year-type).
-    g = pd.DataFrame(
-        (shs_data[
-            [f'z{i}' for i in range(38, 51)]
-            ].values[:, None] 
-         * shs_data[
-             [f'z{j}' for j in range(29, 38)]
-             ].values[..., None]).reshape(shs_data.shape[0], -1)
-        )
-    NAME_g = [f'g{i+1}' for i in range(np.shape(g)[1])]
-    g.columns = NAME_g
-
-    sm = np.where((shs_data['z23'] == 1) & (shs_data['z3'] == 0), 1, 0)
-    sf = np.where((shs_data['z23'] == 1) & (shs_data['z3'] == 1), 1, 0)
-    t = np.vstack((sm, sf)).T
-
-    for i in TYPE:
-        t = np.hstack((t, np.where(shs_data[f'z{i}'] == 1, 1, 0)[:, None]))
-
-    gt = pd.DataFrame(
-        (g.values[:, None] * t[..., None]).reshape(shs_data.shape[0], -1), 
-        index = shs_data.index
-        )
-    gt_excluded = [
-        i for i in range(gt.shape[1]) if len(
-            np.unique(gt[i][gt[i] == 1].index)
-            ) == 1
-        ]
-    gt = gt.reset_index(drop=True)
-    idx_excluded = sum(
-        [gt.index[gt[i] == 1].tolist() for i in gt_excluded], []
-        )
+    group = g[:, 0].astype(np.int64)
+    # Provinces (z29-z37) by years (z38-z50).
+    num_g = len(range(29, 38)) * len(range(38, 51))
+    NAME_g = [f'g{i+1}' for i in range(num_g)]
+
+    # Each observation falls in exactly one group and one type, so locate its 
+    # group-type cell directly rather than forming the N*(G*T) indicators. 
+    # Cells drawn from a single original observation are excluded.
+    gt = t.argmax(axis=1) * len(NAME_g) + group
+    gt_obs = np.unique(np.column_stack((gt, resampling)), axis=0)
+    gt_cells, gt_nobs = np.unique(gt_obs[:, 0], return_counts=True)
+    keep = ~np.isin(gt, gt_cells[gt_nobs == 1])
     
-    shs_data = (
-        shs_data.reset_index(drop=True)
-        ).drop(idx_excluded).reset_index(drop=True)
-    g = g.drop(idx_excluded).reset_index(drop=True)
-    t = np.delete(t, idx_excluded, 0)
+    w_all, y, er, z, t = w_all[keep], y[keep, 0], er[keep], z[keep], t[keep]
+    group = group[keep]
     NAME_t = ['sm', 'sf'] + [f'h{i+1}' for i in range(len(TYPE))]
     t_single = np.hstack(((t[:, 0]+t[:, 1])[:, None], t[:, 2:]))
     NAME_t_single = ['s'] + [f'h{i+1}' for i in range(len(TYPE))]
 
-    gt = csr_array(
-        gt.drop(idx_excluded).reset_index(drop=True).values
-        ).nonzero()
+    gt = (np.arange(t.shape[0]), gt[keep])
     
 
     # Create variables.
-    y = np.log(shs_data['x'].values) - shs_data[f'p{NONSHAREABLE}'].values
-    r = ((shs_data[[f'p{i}' for i in SHAREABLE]]).values 
-         - shs_data[f'p{NONSHAREABLE}'].values[:, None])
-    er = np.exp(r)
-    z = shs_data[[f'z{i}' for i in DEMOG]].values
-    w = ((shs_data[[f's{i}' for i in SHAREABLE]]).values 
-         / shs_data['x'].values[:, None])
-    w_non = shs_data[f's{NONSHAREABLE}'].values / shs_data['x'].values
-    NAME_w = [f'w{i}' for i in SHAREABLE]
+    w = w_all[:, :len(SHAREABLE)]
     wyz = np.hstack((w, y[:, None], z))
     wyz_demean = demean(wyz, gt)
     ery = er * wyz_demean[:, len(SHAREABLE)][:, None]
 
 
     # Group variables by types.
-    eryt = pd.DataFrame(
-        (ery[:, None] * t_single[..., None]).reshape(t_single.shape[0], -1), 
-        columns=[f'er{SHAREABLE[i]}y_{tt}'
+    eryt = (ery[:, None] * t_single[..., None]).reshape(t_single.shape[0], -1)
+    NAME_eryt = [f'er{SHAREABLE[i]}y_{tt}'
                  for tt in NAME_t_single 
                  for i in range(len(SHAREABLE))]
-        )
-    NAME_eryt = eryt.columns.tolist()
-    zt = pd.DataFrame(
-        (wyz_demean[:, (len(SHAREABLE)+1):][:, None]
-         * t[..., None]).reshape(t.shape[0], -1), 
-         columns=[f'z{DEMOG[i]}_{tt}'
-                  for tt in NAME_t 
-                  for i in range(len(DEMOG))]
-        )
-    NAME_zt = zt.columns.tolist()
-
-
-    # Combine variables into a single dataframe.
-    shs_data = pd.concat([
-        pd.DataFrame(
-            wyz_demean[:, range(len(SHAREABLE))], 
-            columns = NAME_w
-            ), 
-        eryt, 
-        zt
-        ], axis=1)
+    zt = (wyz_demean[:, (len(SHAREABLE)+1):][:, None]
+          * t[..., None]).reshape(t.shape[0], -1)
+    NAME_zt = [f'z{DEMOG[i]}_{tt}'
+               for tt in NAME_t 
+               for i in range(len(DEMOG))]
 
 
     # Estimate reduced-form equations (mean Barten scales).
-    mean_boot_eqs = OrderedDict()
-
-    for i in range(len(SHAREABLE)):
-        dep = shs_data[NAME_w[i]]
-        exog = shs_data[
-            [col for col in NAME_eryt if f"er{SHAREABLE[i]}y_" in col] 
-            + NAME_zt
-            ]
-        mean_boot_eqs[f'eq{i+1}'] = {"dependent":dep, "exog":exog}
-
-    mean_boot_est = SUR(mean_boot_eqs).fit(cov_type="unadjusted")
+    mean_boot_params = sur(
+        wyz_demean[:, range(len(SHAREABLE))], 
+        [np.hstack((eryt[:, i::len(SHAREABLE)], zt)) 
+         for i in range(len(SHAREABLE))], 
+        [[col for col in NAME_eryt if f"er{SHAREABLE[i]}y_" in col] + NAME_zt 
+         for i in range(len(SHAREABLE))]
+        )
 
 
     # Prepare data for the estimation of Barten scale variances.
     ery = er * y[:, None]
-    eryt = (ery[:,None] * t_single[...,None]).reshape(t_single.shape[0], -1)
     zt = (z[:,None] * t[...,None]).reshape(t.shape[0], -1)
-    res = np.zeros((np.shape(shs_data)[0], len(SHAREABLE)))
+    # Every equation has the same layout, so the parameters stack into one 
+    # column per equation: the er*y-by-type terms first, then the zt terms.
+    beta = mean_boot_params.values.reshape(len(SHAREABLE), -1).T
+    fres = (w 
+            - ery * (t_single @ beta[:len(NAME_t_single)]) 
+            - zt @ beta[len(NAME_t_single):])
+    res = demean(fres, gt)
+
+    bery = ery * beta[0]
+    iu, ju = np.triu_indices(len(SHAREABLE), k=0)
+    NAME_res_crossprod = pd.Index(
+        [f'res{SHAREABLE[i]}.{SHAREABLE[j]}' for i, j in zip(iu, ju)]
+        )
+    NAME_bery_crossprod = pd.Index(
+        [f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_prod' for i, j in zip(iu, ju)]
+        )
+    NAME_bery_crosssum = pd.Index(
+        [f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_sum' for i, j in zip(iu, ju)]
+        )
+    res_crossprod = triu_prod_nb(res, iu, ju)
+    bery_crossprod = triu_prod_nb(bery, iu, ju)
+    bery_crosssum = triu_sum_nb(bery, iu, ju)
 
-    for i in range(len(SHAREABLE)):
-        fres = w[:, i] - (
-            np.hstack(
-                (eryt[:, np.arange(i, len(NAME_eryt), len(SHAREABLE))], zt)
-                )
-            @ mean_boot_est.params.filter(like=f'eq{i+1}').values[:, None]
-            ).T.flatten()
-        for j in np.unique(gt[1]):
-            index = gt[0][np.where(gt[1] == j)]
-            res[index, i] = fres[index] - np.mean(fres[index])
-
-    bery = ery * mean_boot_est.params.filter(like=f'y_s').values
-    bery_crossprod = pd.DataFrame(index=shs_data.index)
-    bery_crosssum = pd.DataFrame(index=shs_data.index)
-    res_crossprod = pd.DataFrame(index=shs_data.index)
-
-    for i in range(len(SHAREABLE)):
-        for j in range(i, len(SHAREABLE)):
-            res_crossprod = pd.concat(
-                [res_crossprod, 
-                 pd.DataFrame(
-                     res[:, i] * res[:, j], 
-                     columns=[f'res{SHAREABLE[i]}.{SHAREABLE[j]}']
-                     )], 
-                axis=1
-                )
-            bery_crossprod = pd.concat(
-                [bery_crossprod, 
-                 pd.DataFrame(
-                     bery[:, i] * bery[:, j], 
-                     columns=[f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_prod']
-                     )], 
-                axis=1
-                )
-            bery_crosssum = pd.concat(
-                [bery_crosssum, 
-                 pd.DataFrame(
-                     bery[:, i] + bery[:, j], 
-                     columns=[f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_sum']
-                     )], 
-                axis=1
-                )
-        
-    NAME_res_crossprod = res_crossprod.columns
-    NAME_bery_crossprod = bery_crossprod.columns
-    NAME_bery_crosssum = bery_crosssum.columns
-
-    shs_boot_res = pd.concat([
-        pd.DataFrame(t_single[:, 1:], columns=NAME_t[2:]), 
-        res_crossprod, 
-        bery_crossprod, 
-        g, 
-        pd.DataFrame(
-            (bery_crosssum.values[:,None]
-             * g.values[...,None]).reshape(g.shape[0], -1),
-            columns=[f'g{i+1}_{NAME_bery_crosssum[j]}'
-                     for i in range(np.shape(g)[1])
-                     for j in range(len(NAME_bery_crosssum))]
-            )
-        ], 
-        axis=1)[~(t_single[:, 0] == 1)].reset_index(drop=True)
+    # Name the candidate covariance regressors; group_exog() forms the ones 
+    # selected for each equation.
+    NAME_exog = NAME_bery_crossprod.append(pd.Index(
+        [f'{i}_{j}' for i in NAME_g for j in NAME_bery_crosssum]
+        ))
 
 
     # Estimate Barten scale variances.
+    std = np.empty(len(TYPE) * len(SHAREABLE))
+
     for tt in range(len(TYPE)):
-        res_boot = shs_boot_res[shs_boot_res[f'h{tt+1}'] == 1].astype(float)
-        g_included_boot = [i for i in NAME_g if res_boot[i].sum() >= 2]
+        rows = t_single[:, tt+1] == 1
+        group_boot = group[rows]
+        g_included_boot = [
+            NAME_g[i] for i in np.flatnonzero(
+                np.bincount(group_boot, minlength=len(NAME_g)) >= 2
+                )
+            ]
         g_bery_included_boot = [
             f'{i}_{j}' for i in g_included_boot for j in NAME_bery_crosssum
             ]
-        g_new_boot = csr_array(res_boot[NAME_g].values)
-        g_new_boot = g_new_boot.nonzero()
-        res_boot = pd.DataFrame(demean(res_boot.values, g_new_boot), 
-                                columns=res_boot.columns)
-        var_eqs_boot = OrderedDict()
+        g_new_boot = (np.arange(group_boot.shape[0]), group_boot)
+        dep = demean(res_crossprod[rows], g_new_boot)
+        exog_args = (NAME_exog, 
+                     group_boot, 
+                     demean(bery_crossprod[rows], g_new_boot), 
+                     demean(bery_crosssum[rows], g_new_boot))
+        exog_boot = []
         for i in range(len(NAME_res_crossprod)):
-            dep = res_boot[NAME_res_crossprod[i]]
             name = NAME_res_crossprod[i].replace("res", "ber") + 'y'
-            exog = res_boot[[j for j in g_bery_included_boot if name in j] 
-                            + [NAME_bery_crossprod[i]]]
-            
-            var_eqs_boot[f'eq{i+1}'] = {"dependent": dep, "exog": exog}
+            exog_boot.append([j for j in g_bery_included_boot if name in j] 
+                             + [NAME_bery_crossprod[i]])
 
-        cov_est_boot = SUR(var_eqs_boot).fit(cov_type="unadjusted")
+        cov_est_boot = sur(
+            dep, 
+            [group_exog(col, *exog_args) for col in exog_boot], 
+            exog_boot
+            )
         
-        cov_val_new = cov_est_boot.params[
-            cov_est_boot.params.index.str.contains("prod")
-            ]
+        cov_val_new = cov_est_boot[cov_est_boot.index.str.contains("prod")]
         
-        cov = np.empty((len(SHAREABLE), len(SHAREABLE)))
-        cov[np.triu_indices_from(cov, k=0)] = cov_val_new
-        cov[np.tril_indices_from(cov, k=-1)] = cov.T[
-            np.tril_indices_from(cov, k=-1)
-            ]
+        cov = sym_from_upper(cov_val_new, iu, ju)
 
-        cov_pd = NPD.nearestPD(cov)
-        std_new = pd.Series(np.sqrt(np.diag(cov_pd)))
-        std = (std_new.copy() if tt==0 else pd.concat([std, std_new]))
+        cov_pd = nearest_pd(cov)
+        std[tt*len(SHAREABLE):(tt+1)*len(SHAREABLE)] = np.sqrt(np.diag(cov_pd))
 
     return std
 
-def bootstrap_star(args):
-    return bootstrap(*args)
+def share_array(array):
+    """Copy a NumPy array into a new shared memory block.
+
+    Outputs:
+    --------
+    shm:
+        The multiprocessing.shared_memory.SharedMemory block holding the copy. 
+        The caller is responsible for closing and unlinking it.
+    spec:
+        A tuple (name, shape, dtype) from which a worker can attach to it.
+    """
+    shm = SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+
+    return shm, (shm.name, array.shape, array.dtype)
+
+def bootstrap_init(data_spec, resampling_spec, *args):
+    """Attach a worker to the shared sample and resampling indices, and store 
+    the other arguments shared by all bootstrap replications, so that each 
+    task only needs to carry its replication number."""
+    global boot_shm, boot_data, boot_resampling, boot_args
+    boot_shm = [SharedMemory(name=spec[0]) 
+                for spec in (data_spec, resampling_spec)]
+    boot_data, boot_resampling = [
+        np.ndarray(spec[1], dtype=spec[2], buffer=shm.buf) 
+        for spec, shm in zip((data_spec, resampling_spec), boot_shm)
+        ]
+    boot_args = args
+
+def bootstrap_star(k):
+    return bootstrap(boot_resampling[k], boot_data, *boot_args)
 
 
 # Computation starts.
@@ -296,7 +408,8 @@ if __name__ == '__main__':
     NONSHAREABLE = 6 # Nonshareable good
     DEMOG = (1, 2) # Demographic variables
     REP = 1000 # Number of replications in bootstrap
-    np.random.seed(123)
+    SEED = 123 # Seed of the resampling generator
+    rng = np.random.default_rng(SEED)
 
 
     # Read and filter raw data, exclude observations:
@@ -328,89 +441,88 @@ if __name__ == '__main__':
     shs_data = shs_data[selected].reset_index(drop=True)
 
 
-    # Generate a new sample for bootstrap.
-    shs_boot_cols = ([f's{i}' for i in SHAREABLE] 
-                     + [f's{NONSHAREABLE}'] 
-                     + [f'p{i}' for i in SHAREABLE] 
-                     + [f'p{NONSHAREABLE}'] 
-                     + ['x'] 
-                     + [f'z{i}' for i in DEMOG] 
-                     + [f'z{i}' for i in (3, 23)] 
-                     + [f'z{i}' for i in TYPE] 
-                     + [f'z{i}' for i in range(29, 51)])
-    shs_boot = shs_data[shs_boot_cols].to_numpy()
+    # Setup groups (province-year-type). The province (z29-z37) and year 
+    # (z38-z50) blocks are one-hot, so index each province-year group 
+    # directly, in province-major order.
+    prov = shs_data[[f'z{j}' for j in range(29, 38)]].values.argmax(axis=1)
+    year = shs_data[[f'z{i}' for i in range(38, 51)]].values.argmax(axis=1)
+    group = prov * len(range(38, 51)) + year
+    clusters = group + 1
 
+    sm = np.where((shs_data['z23'] == 1) & (shs_data['z3'] == 0), 1, 0)
+    sf = np.where((shs_data['z23'] == 1) & (shs_data['z3'] == 1), 1, 0)
+    t = np.vstack((sm, sf)).T
 
-    # Setup groups (province-year-type).
-    g = pd.DataFrame(
-        (shs_data[
-            [f'z{i}' for i in range(38, 51)]
-            ].values[:, None] 
-         * shs_data[
-             [f'z{j}' for j in range(29, 38)]
-             ].values[..., None]).reshape(shs_data.shape[0], -1)
-        )
-    NAME_g = [f'g{i+1}' for i in range(np.shape(g)[1])]
-    g.columns = NAME_g
-
-    clusters = [
-        int(
-            g.columns[g.iloc[i].isin([1.0])][0].replace('g', '')
-            ) for i in range(g.shape[0])
-            ]
-
+    for i in TYPE:
+        t = np.hstack((t, np.where(shs_data[f'z{i}'] == 1, 1, 0)[:, None]))
 
-    # Generate an 2-d array of indices for the resampling process.
-    resampling = np.random.choice(
-        range(clusters.index(list(set(clusters))[1])), 
-        size=(REP, clusters.index(list(set(clusters))[1]))
-        )
-    for i in range(1, len(list(set(clusters)))-1):
-        resampling_new = np.random.choice(
-            range(clusters.index(list(set(clusters))[i]),
-                  clusters.index(list(set(clusters))[i+1])), 
-            size=(
-                REP, 
-                (clusters.index(list(set(clusters))[i+1])
-                 -clusters.index(list(set(clusters))[i]))
-                )
+    # Generate a new sample for bootstrap. Its variables are transformations 
+    # of single rows, so compute them once here and let every replication 
+    # gather its draws: shares, y, exp(r), demographics, types, and groups.
+    shs_boot = np.column_stack((
+        (shs_data[[f's{i}' for i in SHAREABLE] + [f's{NONSHAREABLE}']].values 
+         / shs_data['x'].values[:, None]), 
+        np.log(shs_data['x'].values) - shs_data[f'p{NONSHAREABLE}'].values, 
+        np.exp(shs_data[[f'p{i}' for i in SHAREABLE]].values 
+               - shs_data[f'p{NONSHAREABLE}'].values[:, None]), 
+        shs_data[[f'z{i}' for i in DEMOG]].values, 
+        t, 
+        group
+        ))
+
+
+    # Generate an 2-d array of indices for the resampling process. The rows 
+    # are sorted by cluster, so each cluster spans the rows [start, end). The 
+    # assert enforces that order, which also makes the starts ascending.
+    assert np.all(np.diff(clusters) >= 0), 'rows must be sorted by cluster'
+    _, starts = np.unique(clusters, return_index=True)
+    ends = np.append(starts[1:], shs_boot.shape[0])
+    resampling = np.empty((REP, shs_boot.shape[0]), dtype=np.int32)
+    for start, end in zip(starts, ends):
+        resampling[:, start:end] = rng.integers(
+            start, end, size=(REP, end-start), dtype=np.int32
             )
-        resampling = np.append(resampling, resampling_new, axis=1)
-    resampling_new = np.random.choice(
-        range(clusters.index(list(set(clusters))[len(list(set(clusters)))-1]), 
-              shs_boot.shape[0]), 
-        size=(
-            REP, 
-            (shs_boot.shape[0]
-             -clusters.index(list(set(clusters))[len(list(set(clusters)))-1]))
-            )
-        )
-    resampling = np.append(resampling, resampling_new, axis = 1)
 
 
     # Bootstrap starts, use parallel process.
-    args = [(resampling[iter], shs_boot) for iter in range(REP)]
-    pool = Pool()
-    results_store = list(tqdm(pool.imap(bootstrap_star, args), total=REP))
-    pool.close()
-    pool.join()
-
-
-    # Translate the output of the bootstrap function into a variable.
-    std_store = np.zeros((REP, int(len(SHAREABLE)*len(TYPE))))
-    for i in range(REP):
-        std_store[i, :] = results_store[i].to_numpy()
-
-
-    # Calculate bootstrap standard errors.
+    shm_boot, boot_spec = share_array(shs_boot)
+    shm_resampling, resampling_spec = share_array(resampling)
+    ncpu = os.cpu_count()
+
+    # Accumulate the mean and the squared deviations of the outputs as they 
+    # arrive (Welford's algorithm), so the replications are never stored.
+    num_std = len(SHAREABLE) * len(TYPE)
+    boot_mean = np.zeros(num_std)
+    boot_m2 = np.zeros(num_std)
+
+    try:
+        with Pool(processes=ncpu, 
+                  maxtasksperchild=2, # A task is a chunk of replications
+                  initializer=bootstrap_init, 
+                  initargs=(boot_spec, resampling_spec)) as pool:
+            for i, result in enumerate(tqdm(
+                pool.imap_unordered(bootstrap_star, 
+                                    range(REP), 
+                                    chunksize=max(1, REP // (4*ncpu))), 
+                total=REP
+                ), start=1):
+                delta = result - boot_mean
+                boot_mean += delta / i
+                boot_m2 += delta * (result - boot_mean)
+    finally:
+        for shm in (shm_boot, shm_resampling):
+            shm.close()
+            shm.unlink()
+
+
+    # Calculate bootstrap standard errors, with the divisor REP of np.std.
     std_se_df = pd.DataFrame(
-        np.std(std_store, axis=0).reshape([len(TYPE), len(SHAREABLE)]).T, 
+        np.sqrt(boot_m2 / REP).reshape([len(TYPE), len(SHAREABLE)]).T, 
         index=[f'w{i}' for i in SHAREABLE], 
-        columns=[f'std.se.h{i}' for i in range(len(TYPE))], 
-        dtype=float
+        columns=[f'std.se.h{i}' for i in range(len(TYPE))]
         )
 
     # Print results.
     np.set_printoptions(precision=4, suppress=True)
     print("standard deviation standard errors")
-    print(std_se_df.astype(float).round(4))
+    print(std_se_df.to_string(float_format='{:.4f}'.format))
@@ -9,7 +9,8 @@ import numpy as np
 import pandas as pd
 
 from multiprocessing import Pool
-from scipy.sparse import csr_array
+from multiprocessing.shared_memory import SharedMemory
+from numba import njit
 from linearmodels.system import SUR
 from collections import OrderedDict
 from sklearn.model_selection import RepeatedKFold
@@ -29,9 +30,9 @@ def demean(var, gt):
         An N*P NumPy array of the sample where N is the number of observations  
         and P is the number of variables.
     gt:
-        A sparse matrix of group indicators generated by the function 
-        scipy.sparse.csr_array(matrix). The input matrix must be an N*G matrix 
-        where N is the number of observations and G is the number of groups.
+        A tuple (row, group) of integer arrays locating the group of each 
+        observation, e.g. (np.arange(N), g.argmax(axis=1)) for an N*G matrix 
+        g of one-hot group indicators.
 
     Outputs:
     --------
@@ -39,14 +40,189 @@ def demean(var, gt):
         An N*P NumPy array of the demeaned sample where N is the number of      
         observations and P is the number of variables.
     """
-    var_demean = np.zeros((var.shape[0], var.shape[1]))
-
-    for i in np.unique(gt[1]):
-        index = gt[0][np.where(gt[1] == i)]
-        var_demean[index, :] = var[index, :] - var[index, :].mean(axis=0)
+    var_demean = demean_nb(
+        np.ascontiguousarray(var, dtype=np.float64), 
+        np.asarray(gt[0], dtype=np.int64), 
+        np.asarray(gt[1], dtype=np.int64), 
+        int(gt[1].max()) + 1
+        )
     
     return var_demean
 
+@njit(cache=True)
+def demean_nb(var, row_idx, grp_idx, num_groups):
+    """Compiled kernel of demean(). Group sums are accumulated in one pass, 
+    then the group means are subtracted in a second."""
+    sums = np.zeros((num_groups, var.shape[1]))
+    counts = np.zeros(num_groups)
+    for k in range(row_idx.shape[0]):
+        counts[grp_idx[k]] += 1
+        sums[grp_idx[k], :] += var[row_idx[k], :]
+
+    var_demean = np.zeros(var.shape)
+    for k in range(row_idx.shape[0]):
+        for p in range(var.shape[1]):
+            var_demean[row_idx[k], p] = (var[row_idx[k], p] 
+                                         - sums[grp_idx[k], p] 
+                                         / counts[grp_idx[k]])
+
+    return var_demean
+
+@njit(cache=True)
+def triu_prod_nb(var, iu, ju):
+    """Return the N*len(iu) array of column products var[:, iu]*var[:, ju]."""
+    out = np.empty((var.shape[0], iu.shape[0]))
+    for n in range(var.shape[0]):
+        for p in range(iu.shape[0]):
+            out[n, p] = var[n, iu[p]] * var[n, ju[p]]
+
+    return out
+
+@njit(cache=True)
+def triu_sum_nb(var, iu, ju):
+    """Return the N*len(iu) array of column sums var[:, iu]+var[:, ju]."""
+    out = np.empty((var.shape[0], iu.shape[0]))
+    for n in range(var.shape[0]):
+        for p in range(iu.shape[0]):
+            out[n, p] = var[n, iu[p]] + var[n, ju[p]]
+
+    return out
+
+def sur(dep, exog, names):
+    """Estimate a system of seemingly unrelated regressions by feasible GLS. 
+    The estimates equal those of linearmodels.system.SUR.fit() with 
+    cov_type="unadjusted", but are computed from NumPy arrays directly.
+
+    Parameters:
+    -----------
+    dep:
+        An N*K NumPy array of the dependent variables where N is the number of 
+        observations and K is the number of equations.
+    exog:
+        A list of K NumPy arrays of the regressors, one N*P_k array for each 
+        equation.
+    names:
+        A list of K lists of the regressor names, one for each equation.
+
+    Outputs:
+    --------
+    params:
+        A pandas Series of the estimated parameters, indexed by 'eq{k}_{name}' 
+        as in linearmodels.
+    """
+    eq = np.repeat(np.arange(len(exog)), [x_k.shape[1] for x_k in exog])
+
+    # One symmetric product of the regressors stacked with the dependent 
+    # variables, which NumPy evaluates with syrk, gives both X'X and X'y.
+    xy = np.hstack(exog + [dep])
+    gram = xy.T @ xy
+    xpx = gram[:eq.shape[0], :eq.shape[0]]
+    xpy = gram[:eq.shape[0], eq.shape[0]:]
+
+    # Equation-by-equation OLS gives the residual covariance matrix.
+    beta = np.concatenate([
+        np.linalg.solve(xpx[np.ix_(eq == k, eq == k)], xpy[eq == k, k]) 
+        for k in range(len(exog))
+        ])
+    eps = dep - np.column_stack(
+        [exog[k] @ beta[eq == k] for k in range(len(exog))]
+        )
+    sigma_inv = np.linalg.inv(eps.T @ eps / dep.shape[0])
+
+    # GLS on the stacked system.
+    beta = np.linalg.solve(
+        xpx * sigma_inv[eq][:, eq], 
+        (xpy @ sigma_inv)[np.arange(eq.shape[0]), eq]
+        )
+
+    return pd.Series(
+        beta, 
+        index=[f'eq{k+1}_{name}' 
+               for k in range(len(names)) for name in names[k]]
+        )
+
+def group_exog(cols, NAME_exog, group, bery_prod, bery_sum):
+    """Assemble the demeaned regressors of a Barten scale variance equation. 
+    Demeaning within groups maps a group-by-crosssum interaction to the group 
+    indicator times the demeaned crosssum, so only the selected columns are 
+    formed instead of all G*P interactions.
+
+    Parameters:
+    -----------
+    cols:
+        A list of the regressor names of the equation.
+    NAME_exog:
+        A pandas Index of all candidate regressor names: the P crossproducts, 
+        followed by the G*P group-by-crosssum interactions ordered by group.
+    group:
+        A NumPy array of length N of the group of each observation.
+    bery_prod:
+        An N*P NumPy array of the demeaned crossproducts.
+    bery_sum:
+        An N*P NumPy array of the demeaned crosssums.
+
+    Outputs:
+    --------
+    exog:
+        An N*len(cols) NumPy array of the regressors.
+    """
+    pos = NAME_exog.get_indexer(cols)
+    prod = pos < bery_prod.shape[1]
+    k, j = np.divmod(pos[~prod] - bery_prod.shape[1], bery_prod.shape[1])
+    exog = np.empty((group.shape[0], pos.shape[0]))
+    exog[:, prod] = bery_prod[:, pos[prod]]
+    exog[:, ~prod] = (group[:, None] == k) * bery_sum[:, j]
+
+    return exog
+
+def sym_from_upper(vec, iu, ju):
+    """Build a symmetric matrix from its upper triangle.
+
+    Parameters:
+    -----------
+    vec:
+        A NumPy array of the upper-triangular entries, ordered as (iu, ju).
+    iu, ju:
+        The row and column indices returned by np.triu_indices(K, k=0).
+
+    Outputs:
+    --------
+    matrix:
+        A K*K symmetric NumPy array.
+    """
+    matrix = np.empty((iu[-1] + 1, iu[-1] + 1))
+    matrix[iu, ju] = vec
+    matrix[ju, iu] = vec
+
+    return matrix
+
+def nearest_pd(matrix, eps=1e-12):
+    """Project a symmetric matrix onto the positive definite matrices by 
+    clipping its eigenvalues at eps. For a small matrix this is one eigh call, 
+    and NPD.nearestPD is only used if the result still fails a Cholesky test.
+
+    Parameters:
+    -----------
+    matrix:
+        A K*K symmetric NumPy array.
+    eps:
+        The smallest eigenvalue allowed in the result.
+
+    Outputs:
+    --------
+    matrix_pd:
+        A K*K positive definite NumPy array.
+    """
+    eigval, eigvec = np.linalg.eigh((matrix + matrix.T) / 2)
+    matrix_pd = (eigvec * np.clip(eigval, eps, None)) @ eigvec.T
+
+    try:
+        np.linalg.cholesky(matrix_pd)
+    except np.linalg.LinAlgError:
+        matrix_pd = NPD.nearestPD(matrix)
+
+    return matrix_pd
+
 def cov_to_cor(cov):
     """Convert a covariance matrix to a correlation matrix.
 
@@ -60,8 +236,8 @@ def cov_to_cor(cov):
     cor:
         A 2-d NumPy array of correlation matrix.
     """
-    v = np.sqrt(np.diag(cov))
-    cor = cov / np.outer(v, v)
+    inv_v = 1 / np.sqrt(np.diag(cov))
+    cor = cov * inv_v[:, None] * inv_v[None, :]
 
     return cor
 
@@ -92,14 +268,14 @@ def barten(theta, num_eq):
 
     return a
 
-def barten_results(mean_est, barten=barten, TYPE=None, NAME_w=None):
+def barten_results(params, barten=barten, TYPE=None, NAME_w=None):
     """Generate a dataframe for Barten scale estimates.
 
     Parameters:
     -----------
-    mean_est:
-        Estimation results of the reduced-form equations for mean Barten scales. 
-        It is genetated directly by the function linearmodels.system.SUR.fit().
+    params:
+        A pandas Series of the estimated parameters of the reduced-form 
+        equations for mean Barten scales. It is generated by the function sur().
     barten:
         A previously defined function that returns Barten scale estimates.
     barten_deriv:
@@ -119,16 +295,12 @@ def barten_results(mean_est, barten=barten, TYPE=None, NAME_w=None):
                      columns=[f'h{i}' for i in range(len(TYPE))], 
                      dtype=float)
 
+    # Each equation lists its er*y coefficients by type (single, h1, h2, ...) 
+    # ahead of the demographics, so the thetas are columns of this reshape.
+    theta_all = params.values.reshape(len(NAME_w), -1)
+
     for i in range(len(TYPE)):
-        theta_s = mean_est.params[
-            (mean_est.params.index.str.contains('s') == True) & 
-            (mean_est.params.index.str.contains('z') == False)
-            ]
-        theta_h = mean_est.params[
-            (mean_est.params.index.str.contains(f'h{i+1}') == True) & 
-            (mean_est.params.index.str.contains('z') == False)
-            ]
-        theta = np.concatenate([theta_s.values, theta_h.values])
+        theta = np.concatenate([theta_all[:, 0], theta_all[:, i+1]])
         
         a[f'h{i}'] = barten(theta, len(NAME_w))
         
@@ -166,8 +338,10 @@ def scale(barten, cov, data, single_indicator, TYPE, NAME_w):
         A NumPy array of the estimated standard deviations of the random 
         household-level scale economies index under different household types.
     """
-    w_bar = data[single_indicator == 1, :].mean(axis=0)
-    w_cov = pd.DataFrame(data[single_indicator == 1, :]).cov().values
+    data_s = data[single_indicator == 1, :]
+    w_bar = data_s.mean(axis=0)
+    data_c = data_s - w_bar
+    w_cov = data_c.T @ data_c / (data_c.shape[0] - 1)
     std = []
     
     for i in range(len(TYPE)):
@@ -193,78 +367,42 @@ def bootstrap(
         SHAREABLE=(1, 2, 8, 17, 19), 
         NONSHAREABLE=6, 
         DEMOG=(1, 2)):
-    # Generate a bootstrap sample.
-    shs_data = pd.DataFrame(
-        shs_data, 
-        columns=([f's{i}' for i in SHAREABLE] 
-                 + [f's{NONSHAREABLE}'] 
-                 + [f'p{i}' for i in SHAREABLE] 
-                 + [f'p{NONSHAREABLE}'] 
-                 + ['x'] 
-                 + [f'z{i}' for i in DEMOG] 
-                 + [f'z{i}' for i in (3, 23)] 
-                 + [f'z{i}' for i in TYPE] 
-                 + [f'z{i}' for i in range(29, 51)])
-        )
-    shs_data = shs_data.loc[resampling]
+    # Generate a bootstrap sample by gathering the precomputed variables.
+    w_all, y, er, z, t, g = np.split(
+        shs_data[resampling], 
+        np.cumsum([len(SHAREABLE) + 1, 
+                   1, 
+                   len(SHAREABLE), 
+                   len(DEMOG), 
+                   len(TYPE) + 2]), 
+        axis=1)
 
 
     # Setup groups (province-year-type).
-    g = pd.DataFrame(
-        (shs_data[
-            [f'z{i}' for i in range(38, 51)]
-            ].values[:, None] 
-         * shs_data[
-             [f'z{j}' for j in range(29, 38)]
-             ].values[..., None]).reshape(shs_data.shape[0], -1)
-        )
-    NAME_g = [f'g{i+1}' for i in range(np.shape(g)[1])]
-    g.columns = NAME_g
-
-    sm = np.where((shs_data['z23'] == 1) & (shs_data['z3'] == 0), 1, 0)
-    sf = np.where((shs_data['z23'] == 1) & (shs_data['z3'] == 1), 1, 0)
-    t = np.vstack((sm, sf)).T
-
-    for i in TYPE:
-        t = np.hstack((t, np.where(shs_data[f'z{i}'] == 1, 1, 0)[:, None]))
-
-    gt = pd.DataFrame(
-        (g.values[:, None] * t[..., None]).reshape(shs_data.shape[0], -1), 
-        index = shs_data.index
-        )
-    gt_excluded = [
-        i for i in range(gt.shape[1]) if len(
-            np.unique(gt[i][gt[i] == 1].index)
-            ) == 1
-        ]
-    gt = gt.reset_index(drop=True)
-    idx_excluded = sum(
-        [gt.index[gt[i] == 1].tolist() for i in gt_excluded], []
-        )
+    group = g[:, 0].astype(np.int64)
+    # Provinces (z29-z37) by years (z38-z50).
+    num_g = len(range(29, 38)) * len(range(38, 51))
+    NAME_g = [f'g{i+1}' for i in range(num_g)]
+
+    # Each observation falls in exactly one group and one type, so locate its 
+    # group-type cell directly rather than forming the N*(G*T) indicators. 
+    # Cells drawn from a single original observation are excluded.
+    gt = t.argmax(axis=1) * len(NAME_g) + group
+    gt_obs = np.unique(np.column_stack((gt, resampling)), axis=0)
+    gt_cells, gt_nobs = np.unique(gt_obs[:, 0], return_counts=True)
+    keep = ~np.isin(gt, gt_cells[gt_nobs == 1])
     
-    shs_data = (
-        shs_data.reset_index(drop=True)
-        ).drop(idx_excluded).reset_index(drop=True)
-    g = g.drop(idx_excluded).reset_index(drop=True)
-    t = np.delete(t, idx_excluded, 0)
+    w_all, y, er, z, t = w_all[keep], y[keep, 0], er[keep], z[keep], t[keep]
+    group = group[keep]
     NAME_t = ['sm', 'sf'] + [f'h{i+1}' for i in range(len(TYPE))]
     t_single = np.hstack(((t[:, 0]+t[:, 1])[:, None], t[:, 2:]))
     NAME_t_single = ['s'] + [f'h{i+1}' for i in range(len(TYPE))]
 
-    gt = csr_array(
-        gt.drop(idx_excluded).reset_index(drop=True).values
-        ).nonzero()
+    gt = (np.arange(t.shape[0]), gt[keep])
     
 
     # Create variables.
-    y = np.log(shs_data['x'].values) - shs_data[f'p{NONSHAREABLE}'].values
-    r = ((shs_data[[f'p{i}' for i in SHAREABLE]]).values 
-         - shs_data[f'p{NONSHAREABLE}'].values[:, None])
-    er = np.exp(r)
-    z = shs_data[[f'z{i}' for i in DEMOG]].values
-    w = ((shs_data[[f's{i}' for i in SHAREABLE]]).values 
-         / shs_data['x'].values[:, None])
-    w_non = shs_data[f's{NONSHAREABLE}'].values / shs_data['x'].values
+    w = w_all[:, :len(SHAREABLE)]
     NAME_w = [f'w{i}' for i in SHAREABLE]
     wyz = np.hstack((w, y[:, None], z))
     wyz_demean = demean(wyz, gt)
@@ -272,257 +410,165 @@ def bootstrap(
 
 
     # Group variables by types.
-    eryt = pd.DataFrame(
-        (ery[:, None] * t_single[..., None]).reshape(t_single.shape[0], -1), 
-        columns=[f'er{SHAREABLE[i]}y_{tt}'
+    eryt = (ery[:, None] * t_single[..., None]).reshape(t_single.shape[0], -1)
+    NAME_eryt = [f'er{SHAREABLE[i]}y_{tt}'
                  for tt in NAME_t_single 
                  for i in range(len(SHAREABLE))]
-        )
-    NAME_eryt = eryt.columns.tolist()
-    zt = pd.DataFrame(
-        (wyz_demean[:, (len(SHAREABLE)+1):][:, None]
-         * t[..., None]).reshape(t.shape[0], -1), 
-         columns=[f'z{DEMOG[i]}_{tt}'
-                  for tt in NAME_t 
-                  for i in range(len(DEMOG))]
-        )
-    NAME_zt = zt.columns.tolist()
-
-
-    # Combine variables into a single dataframe.
-    shs_data = pd.concat([
-        pd.DataFrame(
-            wyz_demean[:, range(len(SHAREABLE))], 
-            columns = NAME_w
-            ), 
-        eryt, 
-        zt
-        ], axis=1)
-    w_all = np.hstack((w, w_non[:, None]))
+    zt = (wyz_demean[:, (len(SHAREABLE)+1):][:, None]
+          * t[..., None]).reshape(t.shape[0], -1)
+    NAME_zt = [f'z{DEMOG[i]}_{tt}'
+               for tt in NAME_t 
+               for i in range(len(DEMOG))]
 
 
     # Estimate reduced-form equations (mean Barten scales).
-    mean_boot_eqs = OrderedDict()
-
-    for i in range(len(SHAREABLE)):
-        dep = shs_data[NAME_w[i]]
-        exog = shs_data[
-            [col for col in NAME_eryt if f"er{SHAREABLE[i]}y_" in col] 
-            + NAME_zt
-            ]
-        mean_boot_eqs[f'eq{i+1}'] = {"dependent":dep, "exog":exog}
-
-    mean_boot_est = SUR(mean_boot_eqs).fit(cov_type="unadjusted")
+    mean_boot_params = sur(
+        wyz_demean[:, range(len(SHAREABLE))], 
+        [np.hstack((eryt[:, i::len(SHAREABLE)], zt)) 
+         for i in range(len(SHAREABLE))], 
+        [[col for col in NAME_eryt if f"er{SHAREABLE[i]}y_" in col] + NAME_zt 
+         for i in range(len(SHAREABLE))]
+        )
 
 
     # Prepare data for the estimation of Barten scale variances.
     ery = er * y[:, None]
-    eryt = (ery[:,None] * t_single[...,None]).reshape(t_single.shape[0], -1)
     zt = (z[:,None] * t[...,None]).reshape(t.shape[0], -1)
-    res = np.zeros((np.shape(shs_data)[0], len(SHAREABLE)))
-
-    for i in range(len(SHAREABLE)):
-        fres = w[:, i] - (
-            np.hstack(
-                (eryt[:, np.arange(i, len(NAME_eryt), len(SHAREABLE))], zt)
-                )
-            @ mean_boot_est.params.filter(like=f'eq{i+1}').values[:, None]
-            ).T.flatten()
-        for j in np.unique(gt[1]):
-            index = gt[0][np.where(gt[1] == j)]
-            res[index, i] = fres[index] - np.mean(fres[index])
-
-    bery = ery * mean_boot_est.params.filter(like=f'y_s').values
-    bery_crossprod = pd.DataFrame(index=shs_data.index)
-    bery_crosssum = pd.DataFrame(index=shs_data.index)
-    res_crossprod = pd.DataFrame(index=shs_data.index)
-
-    for i in range(len(SHAREABLE)):
-        for j in range(i, len(SHAREABLE)):
-            res_crossprod = pd.concat(
-                [res_crossprod, 
-                 pd.DataFrame(
-                     res[:, i] * res[:, j], 
-                     columns=[f'res{SHAREABLE[i]}.{SHAREABLE[j]}']
-                     )], 
-                axis=1
-                )
-            bery_crossprod = pd.concat(
-                [bery_crossprod, 
-                 pd.DataFrame(
-                     bery[:, i] * bery[:, j], 
-                     columns=[f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_prod']
-                     )], 
-                axis=1
-                )
-            bery_crosssum = pd.concat(
-                [bery_crosssum, 
-                 pd.DataFrame(
-                     bery[:, i] + bery[:, j], 
-                     columns=[f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_sum']
-                     )], 
-                axis=1
-                )
-        
-    NAME_res_crossprod = res_crossprod.columns
-    NAME_bery_crossprod = bery_crossprod.columns
-    NAME_bery_crosssum = bery_crosssum.columns
+    # Every equation has the same layout, so the parameters stack into one 
+    # column per equation: the er*y-by-type terms first, then the zt terms.
+    beta = mean_boot_params.values.reshape(len(SHAREABLE), -1).T
+    fres = (w 
+            - ery * (t_single @ beta[:len(NAME_t_single)]) 
+            - zt @ beta[len(NAME_t_single):])
+    res = demean(fres, gt)
+
+    bery = ery * beta[0]
+    iu, ju = np.triu_indices(len(SHAREABLE), k=0)
+    NAME_res_crossprod = pd.Index(
+        [f'res{SHAREABLE[i]}.{SHAREABLE[j]}' for i, j in zip(iu, ju)]
+        )
+    NAME_bery_crossprod = pd.Index(
+        [f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_prod' for i, j in zip(iu, ju)]
+        )
+    NAME_bery_crosssum = pd.Index(
+        [f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_sum' for i, j in zip(iu, ju)]
+        )
+    res_crossprod = triu_prod_nb(res, iu, ju)
+    bery_crossprod = triu_prod_nb(bery, iu, ju)
+    bery_crosssum = triu_sum_nb(bery, iu, ju)
 
-    shs_boot_res = pd.concat([
-        pd.DataFrame(t_single[:, 1:], columns=NAME_t[2:]), 
-        res_crossprod, 
-        bery_crossprod, 
-        g, 
-        pd.DataFrame(
-            (bery_crosssum.values[:,None]
-             * g.values[...,None]).reshape(g.shape[0], -1),
-            columns=[f'g{i+1}_{NAME_bery_crosssum[j]}'
-                     for i in range(np.shape(g)[1])
-                     for j in range(len(NAME_bery_crosssum))]
-            )
-        ], 
-        axis=1)[~(t_single[:, 0] == 1)].reset_index(drop=True)
+    # Name the candidate covariance regressors; group_exog() forms the ones 
+    # selected for each equation.
+    NAME_exog = NAME_bery_crossprod.append(pd.Index(
+        [f'{i}_{j}' for i in NAME_g for j in NAME_bery_crosssum]
+        ))
 
 
     # Estimate Barten scale variances, standard deviations, and correlations.
     cov_matrix_pd = np.empty((len(SHAREABLE), len(SHAREABLE), len(TYPE)))
     cov_matrix_pd_l = np.empty((len(SHAREABLE), len(SHAREABLE), len(TYPE)))
     cov_matrix_pd_u = np.empty((len(SHAREABLE), len(SHAREABLE), len(TYPE)))
+    cov = np.empty(len(TYPE) * len(iu))
+    cov_pd = np.empty_like(cov)
+    cor = np.empty_like(cov)
+    std = np.empty(len(TYPE) * len(SHAREABLE))
+    std_l = np.empty_like(std)
+    std_u = np.empty_like(std)
 
     for tt in range(len(TYPE)):
-        res_boot = shs_boot_res[shs_boot_res[f'h{tt+1}'] == 1].astype(float)
-        g_included_boot = [i for i in NAME_g if res_boot[i].sum() >= 2]
+        rows = t_single[:, tt+1] == 1
+        group_boot = group[rows]
+        g_included_boot = [
+            NAME_g[i] for i in np.flatnonzero(
+                np.bincount(group_boot, minlength=len(NAME_g)) >= 2
+                )
+            ]
         g_bery_included_boot = [
             f'{i}_{j}' for i in g_included_boot for j in NAME_bery_crosssum
             ]
-        g_new_boot = csr_array(res_boot[NAME_g].values)
-        g_new_boot = g_new_boot.nonzero()
-        res_boot = pd.DataFrame(demean(res_boot.values, g_new_boot), 
-                                columns=res_boot.columns)
-        var_eqs_boot = OrderedDict()
-        var_eqs_l_boot = OrderedDict()
-        var_eqs_u_boot = OrderedDict()
+        g_new_boot = (np.arange(group_boot.shape[0]), group_boot)
+        dep = demean(res_crossprod[rows], g_new_boot)
+        exog_args = (NAME_exog, 
+                     group_boot, 
+                     demean(bery_crossprod[rows], g_new_boot), 
+                     demean(bery_crosssum[rows], g_new_boot))
+        exog_boot = []
+        exog_l_boot = []
+        exog_u_boot = []
         for i in range(len(NAME_res_crossprod)):
-            dep = res_boot[NAME_res_crossprod[i]]
             name = NAME_res_crossprod[i].replace("res", "ber") + 'y'
-            exog = res_boot[[j for j in g_bery_included_boot if name in j] 
-                            + [NAME_bery_crossprod[i]]]
+            exog = ([j for j in g_bery_included_boot if name in j] 
+                    + [NAME_bery_crossprod[i]])
             
-            var_eqs_boot[f'eq{i+1}'] = {
-                "dependent": dep, 
-                "exog": exog[
-                    [col for col in lasso_selec[tt*len(NAME_res_crossprod)+i]
-                     if col in exog.columns.tolist()]
-                    ]
-                }
-            var_eqs_l_boot[f'eq{i+1}'] = {
-                "dependent": dep, 
-                "exog": exog[
-                    [col for col in lasso_l[tt*len(NAME_res_crossprod)+i]
-                     if col in exog.columns.tolist()]
-                    ]
-                }
-            var_eqs_u_boot[f'eq{i+1}'] = {
-                "dependent": dep, 
-                "exog": exog[
-                    [col for col in lasso_u[tt*len(NAME_res_crossprod)+i]
-                     if col in exog.columns.tolist()]
-                    ]
-                }
-
-        cov_est_boot = SUR(var_eqs_boot).fit(cov_type="unadjusted")
-        cov_est_l_boot = SUR(var_eqs_l_boot).fit(cov_type="unadjusted")
-        cov_est_u_boot = SUR(var_eqs_u_boot).fit(cov_type="unadjusted")
-        
-        cov_val_new = cov_est_boot.params[
-            cov_est_boot.params.index.str.contains("prod")
-            ]
-        cov_val_l = cov_est_l_boot.params[
-            cov_est_l_boot.params.index.str.contains("prod")
-            ]
-        cov_val_u = cov_est_u_boot.params[
-            cov_est_u_boot.params.index.str.contains("prod")
-            ]
-        
-        cov_val_new.index = cov_val_new.index + f'_h{tt+1}'
-
-        cov_matrix = np.empty((len(SHAREABLE), len(SHAREABLE)))
-        cov_matrix[np.triu_indices_from(cov_matrix, k=0)] = cov_val_new
-        cov_matrix[np.tril_indices_from(cov_matrix, k=-1)] = cov_matrix.T[
-            np.tril_indices_from(cov_matrix, k=-1)
-            ]
-
-        cov_l = np.empty((len(SHAREABLE), len(SHAREABLE)))
-        cov_l[np.triu_indices_from(cov_l, k=0)] = cov_val_l
-        cov_l[np.tril_indices_from(cov_l, k=-1)] = cov_l.T[
-            np.tril_indices_from(cov_l, k=-1)
-            ]
-
-        cov_u = np.empty((len(SHAREABLE), len(SHAREABLE)))
-        cov_u[np.triu_indices_from(cov_u, k=0)] = cov_val_u
-        cov_u[np.tril_indices_from(cov_u, k=-1)] = cov_u.T[
-            np.tril_indices_from(cov_u, k=-1)
-            ]
-
-        cov_matrix_pd[:, :, tt] = NPD.nearestPD(cov_matrix)
-        cov_matrix_pd_l[:, :, tt] = NPD.nearestPD(cov_l)
-        cov_matrix_pd_u[:, :, tt] = NPD.nearestPD(cov_u)
-        cor_matrix = cov_to_cor(cov_matrix_pd[:, :, tt])
+            exog_boot.append(
+                [col for col in lasso_selec[tt*len(NAME_res_crossprod)+i]
+                 if col in exog]
+                )
+            exog_l_boot.append(
+                [col for col in lasso_l[tt*len(NAME_res_crossprod)+i]
+                 if col in exog]
+                )
+            exog_u_boot.append(
+                [col for col in lasso_u[tt*len(NAME_res_crossprod)+i]
+                 if col in exog]
+                )
 
-        cov_pd_new = pd.Series(
-            cov_matrix_pd[:, :, tt][
-                np.triu_indices_from(cov_matrix_pd[:, :, tt], k=0)
-                ]
-            )
-        cor_new = pd.Series(
-            cor_matrix[np.triu_indices_from(cor_matrix, k=0)]
+        cov_est_boot = sur(
+            dep, 
+            [group_exog(col, *exog_args) for col in exog_boot], 
+            exog_boot
             )
-        stdev_new = pd.Series(
-            np.sqrt(np.diag(cov_matrix_pd[:, :, tt]))
+        cov_est_l_boot = sur(
+            dep, 
+            [group_exog(col, *exog_args) for col in exog_l_boot], 
+            exog_l_boot
             )
-        stdev_new_l = pd.Series(
-            np.sqrt(np.diag(cov_matrix_pd_l[:, :, tt]))
-            )
-        stdev_new_u = pd.Series(
-            np.sqrt(np.diag(cov_matrix_pd_u[:, :, tt]))
+        cov_est_u_boot = sur(
+            dep, 
+            [group_exog(col, *exog_args) for col in exog_u_boot], 
+            exog_u_boot
             )
+        
+        cov_val_new = cov_est_boot[cov_est_boot.index.str.contains("prod")]
+        cov_val_l = cov_est_l_boot[cov_est_l_boot.index.str.contains("prod")]
+        cov_val_u = cov_est_u_boot[cov_est_u_boot.index.str.contains("prod")]
 
-        cov = (cov_val_new.copy() if tt==0 else pd.concat(
-            [cov, cov_val_new]
-            ))
-        cov_pd = (cov_pd_new.copy() if tt==0 else pd.concat(
-            [cov_pd, cov_pd_new]
-            ))
-        cor = (cor_new.copy() if tt==0 else pd.concat(
-            [cor, cor_new]
-            ))
-        std = (stdev_new.copy() if tt==0 else pd.concat(
-            [std, stdev_new]
-            ))
-        std_l = (stdev_new_l.copy() if tt==0 else pd.concat(
-            [std_l, stdev_new_l]
-            ))
-        std_u = (stdev_new_u.copy() if tt==0 else pd.concat(
-            [std_u, stdev_new_u]
-            ))
+        cov_matrix = sym_from_upper(cov_val_new, iu, ju)
+        cov_l = sym_from_upper(cov_val_l, iu, ju)
+        cov_u = sym_from_upper(cov_val_u, iu, ju)
+
+        cov_matrix_pd[:, :, tt] = nearest_pd(cov_matrix)
+        cov_matrix_pd_l[:, :, tt] = nearest_pd(cov_l)
+        cov_matrix_pd_u[:, :, tt] = nearest_pd(cov_u)
+        cor_matrix = cov_to_cor(cov_matrix_pd[:, :, tt])
+
+        tri = slice(tt * len(iu), (tt+1) * len(iu))
+        diag = slice(tt * len(SHAREABLE), (tt+1) * len(SHAREABLE))
+        cov[tri] = cov_val_new
+        cov_pd[tri] = cov_matrix_pd[:, :, tt][iu, ju]
+        cor[tri] = cor_matrix[iu, ju]
+        std[diag] = np.sqrt(np.diag(cov_matrix_pd[:, :, tt]))
+        std_l[diag] = np.sqrt(np.diag(cov_matrix_pd_l[:, :, tt]))
+        std_u[diag] = np.sqrt(np.diag(cov_matrix_pd_u[:, :, tt]))
 
     # Estimate standard deviation of the scale economies index.
+    barten_boot = barten_results(mean_boot_params, TYPE=TYPE, NAME_w=NAME_w)
     std_scale_s = scale(
-        barten_results(mean_boot_est, TYPE=TYPE, NAME_w=NAME_w), 
+        barten_boot, 
         cov_matrix_pd, 
         w_all, 
         t_single[:, 0], 
         TYPE, 
         NAME_w)
     std_scale_sm = scale(
-        barten_results(mean_boot_est, TYPE=TYPE, NAME_w=NAME_w), 
+        barten_boot, 
         cov_matrix_pd, 
         w_all, 
         t[:, 0], 
         TYPE, 
         NAME_w)
     std_scale_sf = scale(
-        barten_results(mean_boot_est, TYPE=TYPE, NAME_w=NAME_w), 
+        barten_boot, 
         cov_matrix_pd, 
         w_all, 
         t[:, 1], 
@@ -532,8 +578,41 @@ def bootstrap(
     return (cov, cov_pd, cor, std, std_scale_s, std_scale_sm, 
             std_scale_sf, std_l, std_u)
 
-def bootstrap_star(args):
-    return bootstrap(*args)
+def share_array(array):
+    """Copy a NumPy array into a new shared memory block.
+
+    Outputs:
+    --------
+    shm:
+        The multiprocessing.shared_memory.SharedMemory block holding the copy. 
+        The caller is responsible for closing and unlinking it.
+    spec:
+        A tuple (name, shape, dtype) from which a worker can attach to it.
+    """
+    shm = SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+
+    return shm, (shm.name, array.shape, array.dtype)
+
+def bootstrap_init(data_spec, resampling_spec, *args):
+    """Attach a worker to the shared sample and resampling indices, and store 
+    the other arguments shared by all bootstrap replications, so that each 
+    task only needs to carry its replication number."""
+    global boot_shm, boot_data, boot_resampling, boot_args
+    boot_shm = [SharedMemory(name=spec[0]) 
+                for spec in (data_spec, resampling_spec)]
+    boot_data, boot_resampling = [
+        np.ndarray(spec[1], dtype=spec[2], buffer=shm.buf) 
+        for spec, shm in zip((data_spec, resampling_spec), boot_shm)
+        ]
+    boot_args = args
+
+def bootstrap_star(k):
+    """Run the k-th bootstrap replication and return all of its outputs 
+    concatenated into one array, which is cheaper to send back than a tuple."""
+    return np.concatenate(
+        bootstrap(boot_resampling[k], boot_data, *boot_args)
+        )
 
 
 # Computation starts.
@@ -547,7 +626,8 @@ if __name__ == '__main__':
     NONSHAREABLE = 6 # Nonshareable good
     DEMOG = (1, 2) # Demographic variables
     REP = 1000 # Number of replications in bootstrap
-    np.random.seed(123)
+    SEED = 123 # Seed of the resampling generator
+    rng = np.random.default_rng(SEED)
 
 
     # Read and filter raw data, exclude observations:
@@ -579,36 +659,16 @@ if __name__ == '__main__':
     shs_data = shs_data[selected].reset_index(drop=True)
 
 
-    # Generate a new sample for bootstrap.
-    shs_boot_cols = ([f's{i}' for i in SHAREABLE] 
-                     + [f's{NONSHAREABLE}'] 
-                     + [f'p{i}' for i in SHAREABLE] 
-                     + [f'p{NONSHAREABLE}'] 
-                     + ['x'] 
-                     + [f'z{i}' for i in DEMOG] 
-                     + [f'z{i}' for i in (3, 23)] 
-                     + [f'z{i}' for i in TYPE] 
-                     + [f'z{i}' for i in range(29, 51)])
-    shs_boot = shs_data[shs_boot_cols].to_numpy()
-
-
     # Setup groups (province-year-type).
-    g = pd.DataFrame(
-        (shs_data[
-            [f'z{i}' for i in range(38, 51)]
-            ].values[:, None] 
-         * shs_data[
-             [f'z{j}' for j in range(29, 38)]
-             ].values[..., None]).reshape(shs_data.shape[0], -1)
-        )
+    g = np.einsum(
+        'ni,nj->nij', 
+        shs_data[[f'z{j}' for j in range(29, 38)]].values, 
+        shs_data[[f'z{i}' for i in range(38, 51)]].values
+        ).reshape(shs_data.shape[0], -1)
     NAME_g = [f'g{i+1}' for i in range(np.shape(g)[1])]
-    g.columns = NAME_g
+    g = pd.DataFrame(g, columns=NAME_g)
 
-    clusters = [
-        int(
-            g.columns[g.iloc[i].isin([1.0])][0].replace('g', '')
-            ) for i in range(g.shape[0])
-        ]
+    clusters = g.values.argmax(axis=1) + 1 # g is one-hot
 
     sm = np.where((shs_data['z23'] == 1) & (shs_data['z3'] == 0), 1, 0)
     sf = np.where((shs_data['z23'] == 1) & (shs_data['z3'] == 1), 1, 0)
@@ -617,26 +677,33 @@ if __name__ == '__main__':
     for i in TYPE:
         t = np.hstack((t, np.where(shs_data[f'z{i}'] == 1, 1, 0)[:, None]))
 
-    gt = pd.DataFrame(
-        (g.values[:, None]*t[..., None]).reshape(shs_data.shape[0], -1)
-        )
-    gt_excluded = [i for i in range(gt.shape[1]) if gt[i].sum() == 1]
-    idx_excluded = [
-        gt.index[
-            gt[gt_excluded[i]] == 1
-            ].tolist()[0] for i in range(len(gt_excluded))
-            ]
-
-    shs_data = shs_data.drop(idx_excluded).reset_index(drop=True)
-    g = g.drop(idx_excluded).reset_index(drop=True)
-    t = np.delete(t, idx_excluded, 0)
+    # Each observation falls in exactly one group and one type, so locate its 
+    # group-type cell directly rather than forming the N*(G*T) indicators.
+    gt = t.argmax(axis=1) * g.shape[1] + g.values.argmax(axis=1)
+    keep = np.bincount(gt)[gt] > 1
+
+    # Generate a new sample for bootstrap. Its variables are transformations 
+    # of single rows, so compute them once here and let every replication 
+    # gather its draws: shares, y, exp(r), demographics, types, and groups.
+    shs_boot = np.column_stack((
+        (shs_data[[f's{i}' for i in SHAREABLE] + [f's{NONSHAREABLE}']].values 
+         / shs_data['x'].values[:, None]), 
+        np.log(shs_data['x'].values) - shs_data[f'p{NONSHAREABLE}'].values, 
+        np.exp(shs_data[[f'p{i}' for i in SHAREABLE]].values 
+               - shs_data[f'p{NONSHAREABLE}'].values[:, None]), 
+        shs_data[[f'z{i}' for i in DEMOG]].values, 
+        t, 
+        g.values.argmax(axis=1)
+        ))
+
+    shs_data = shs_data[keep].reset_index(drop=True)
+    g = g[keep].reset_index(drop=True)
+    t = t[keep]
     NAME_t = ['sm', 'sf'] + [f'h{i+1}' for i in range(len(TYPE))]
     t_single = np.hstack(((t[:, 0] + t[:, 1])[:, None], t[:, 2:]))
     NAME_t_single = ['s'] + [f'h{i+1}' for i in range(len(TYPE))]
 
-    gt = csr_array(
-        gt.drop(idx_excluded).reset_index(drop=True).values
-        ).nonzero()
+    gt = (np.arange(t.shape[0]), gt[keep])
     
 
     # Create variables.
@@ -712,55 +779,35 @@ if __name__ == '__main__':
 
     # Prepare data for the estimation of Barten scale variances.
     ery = er * y[:, None]
-    eryt = (ery[:,None] * t_single[...,None]).reshape(t_single.shape[0], -1)
     zt = (z[:,None] * t[...,None]).reshape(t.shape[0], -1)
-    res = np.zeros((np.shape(shs_data)[0], len(SHAREABLE)))
-
-    for i in range(len(SHAREABLE)):
-        fres = w[:, i] - (
-            np.hstack(
-                (eryt[:, np.arange(i, len(NAME_eryt), len(SHAREABLE))], zt)
-                ) @ mean_est.params.filter(like=f'eq{i+1}').values[:, None]
-            ).T.flatten()
-        for j in np.unique(gt[1]):
-            index = gt[0][np.where(gt[1] == j)]
-            res[index, i] = fres[index] - np.mean(fres[index])
-
-    bery = ery * mean_est.params.filter(like=f'y_s').values
-    bery_crossprod = pd.DataFrame(index=shs_data.index)
-    bery_crosssum = pd.DataFrame(index=shs_data.index)
-    res_crossprod = pd.DataFrame(index=shs_data.index)
-
-    for i in range(len(SHAREABLE)):
-        for j in range(i, len(SHAREABLE)):
-            res_crossprod = pd.concat(
-                [res_crossprod, 
-                 pd.DataFrame(
-                     res[:, i] * res[:, j], 
-                     columns=[f'res{SHAREABLE[i]}.{SHAREABLE[j]}']
-                     )], 
-                axis=1
-                )
-            bery_crossprod = pd.concat(
-                [bery_crossprod, 
-                 pd.DataFrame(
-                     bery[:, i] * bery[:, j], 
-                     columns=[f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_prod']
-                     )], 
-                axis=1
-                )
-            bery_crosssum = pd.concat(
-                [bery_crosssum, 
-                 pd.DataFrame(
-                     bery[:, i] + bery[:, j], 
-                     columns=[f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_sum']
-                     )], 
-                axis=1
-                )
-        
-    NAME_res_crossprod = res_crossprod.columns
-    NAME_bery_crossprod = bery_crossprod.columns
-    NAME_bery_crosssum = bery_crosssum.columns
+    # Every equation has the same layout, so the parameters stack into one 
+    # column per equation: the er*y-by-type terms first, then the zt terms.
+    beta = mean_est.params.values.reshape(len(SHAREABLE), -1).T
+    fres = (w 
+            - ery * (t_single @ beta[:len(NAME_t_single)]) 
+            - zt @ beta[len(NAME_t_single):])
+    res = demean(fres, gt)
+
+    bery = ery * beta[0]
+    iu, ju = np.triu_indices(len(SHAREABLE), k=0)
+    NAME_res_crossprod = pd.Index(
+        [f'res{SHAREABLE[i]}.{SHAREABLE[j]}' for i, j in zip(iu, ju)]
+        )
+    NAME_bery_crossprod = pd.Index(
+        [f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_prod' for i, j in zip(iu, ju)]
+        )
+    NAME_bery_crosssum = pd.Index(
+        [f'ber{SHAREABLE[i]}.{SHAREABLE[j]}y_sum' for i, j in zip(iu, ju)]
+        )
+    res_crossprod = pd.DataFrame(
+        triu_prod_nb(res, iu, ju), columns=NAME_res_crossprod, copy=False
+        )
+    bery_crossprod = pd.DataFrame(
+        triu_prod_nb(bery, iu, ju), columns=NAME_bery_crossprod, copy=False
+        )
+    bery_crosssum = pd.DataFrame(
+        triu_sum_nb(bery, iu, ju), columns=NAME_bery_crosssum, copy=False
+        )
 
     shs_res = pd.concat([
         pd.DataFrame(t_single[:, 1:], columns=NAME_t[2:]), 
@@ -768,8 +815,9 @@ if __name__ == '__main__':
         bery_crossprod, 
         g, 
         pd.DataFrame(
-            (bery_crosssum.values[:,None]
-             * g.values[...,None]).reshape(g.shape[0], -1),
+            np.einsum(
+                'ni,nj->nij', g.values, bery_crosssum.values
+                ).reshape(g.shape[0], -1),
             columns=[f'g{i+1}_{NAME_bery_crosssum[j]}'
                      for i in range(np.shape(g)[1])
                      for j in range(len(NAME_bery_crosssum))]
@@ -777,7 +825,7 @@ if __name__ == '__main__':
         ], 
         axis=1)[~(t_single[:, 0] == 1)].reset_index(drop=True)
 
-    del w, y, er, ery, res, z, zt, fres, index, r, eryt, bery, g
+    del w, y, er, ery, res, z, zt, fres, beta, r, bery, g
     del res_crossprod, bery_crossprod, bery_crosssum
     
     
@@ -795,8 +843,8 @@ if __name__ == '__main__':
         g_bery_included = [
             f'{i}_{j}' for i in g_included for j in NAME_bery_crosssum
             ]
-        g_new = csr_array(res_data[NAME_g].values)
-        g_new = g_new.nonzero()
+        g_new = (np.arange(res_data.shape[0]), 
+                 res_data[NAME_g].values.argmax(axis=1))
         res_data = pd.DataFrame(demean(res_data.values, g_new), 
                                 columns=res_data.columns)
 
@@ -807,6 +855,8 @@ if __name__ == '__main__':
                             + [NAME_bery_crossprod[i]]]
             cv = RepeatedKFold(random_state=123)
             penalty = np.array([1.0]*(exog.shape[1]-1) + [0.0])
+            exog_np = exog.to_numpy()
+            dep_np = dep.to_numpy()
             
             lasso_model = CustomENetCV(
                 cv, 
@@ -814,19 +864,19 @@ if __name__ == '__main__':
                 fit_intercept=False, 
                 verbose=False, 
                 max_iter=10000)
-            lasso_model.fit(exog.to_numpy(), dep.to_numpy(), s=penalty)
+            lasso_model.fit(exog_np, dep_np, s=penalty)
 
             lasso_model_l = CustomENet(
                 lasso_model.alpha_best*0.5, 
                 l1_ratio=1, 
                 fit_intercept=False)
-            lasso_model_l.fit(exog.to_numpy(), dep.to_numpy(), s=penalty)
+            lasso_model_l.fit(exog_np, dep_np, s=penalty)
 
             lasso_model_u = CustomENet(
                 lasso_model.alpha_best*2, 
                 l1_ratio=1, 
                 fit_intercept=False)
-            lasso_model_u.fit(exog.to_numpy(), dep.to_numpy(), s=penalty)
+            lasso_model_u.fit(exog_np, dep_np, s=penalty)
 
             lasso_selec.append(
                 exog.columns[np.nonzero(lasso_model.w)[0]].tolist()
@@ -839,152 +889,98 @@ if __name__ == '__main__':
                 )
 
 
-    # Generate an 2-d array of indices for the resampling process.
-    resampling = np.random.choice(
-        range(clusters.index(list(set(clusters))[1])), 
-        size=(REP, clusters.index(list(set(clusters))[1]))
-        )
-    for i in range(1, len(list(set(clusters)))-1):
-        resampling_new = np.random.choice(
-            range(clusters.index(list(set(clusters))[i]),
-                  clusters.index(list(set(clusters))[i+1])), 
-            size=(
-                REP, 
-                (clusters.index(list(set(clusters))[i+1])
-                 -clusters.index(list(set(clusters))[i]))
-                )
-            )
-        resampling = np.append(resampling, resampling_new, axis=1)
-    resampling_new = np.random.choice(
-        range(clusters.index(list(set(clusters))[len(list(set(clusters)))-1]), 
-              shs_boot.shape[0]), 
-        size=(
-            REP, 
-            (shs_boot.shape[0]
-             -clusters.index(list(set(clusters))[len(list(set(clusters)))-1]))
+    # Generate an 2-d array of indices for the resampling process. The rows 
+    # are sorted by cluster, so each cluster spans the rows [start, end). The 
+    # assert enforces that order, which also makes the starts ascending.
+    assert np.all(np.diff(clusters) >= 0), 'rows must be sorted by cluster'
+    _, starts = np.unique(clusters, return_index=True)
+    ends = np.append(starts[1:], shs_boot.shape[0])
+    resampling = np.empty((REP, shs_boot.shape[0]), dtype=np.int32)
+    for start, end in zip(starts, ends):
+        resampling[:, start:end] = rng.integers(
+            start, end, size=(REP, end-start), dtype=np.int32
             )
-        )
-    resampling = np.append(resampling, resampling_new, axis=1)
-
-
-    # Bootstrap starts, use parallel process.
-    args = [(resampling[iter], 
-             shs_boot, 
-             lasso_selec, 
-             lasso_l, 
-             lasso_u) for iter in range(REP)]
-    pool = Pool()
-    results_store = list(tqdm(pool.imap(bootstrap_star, args), total=REP))
-    pool.close()
-    pool.join()
 
 
-    # Translate the output of the bootstrap function into variables.
-    cov_store = np.zeros(
-        (REP, int((len(SHAREABLE)*(len(SHAREABLE)+1)/2)*len(TYPE)))
+    # Bootstrap starts, use parallel process. Each replication returns its 
+    # outputs in one array, with the lengths below.
+    num_cov = len(SHAREABLE) * (len(SHAREABLE)+1) // 2 * len(TYPE)
+    num_std = len(SHAREABLE) * len(TYPE)
+    sizes = [num_cov] * 3 + [num_std] + [len(TYPE)] * 3 + [num_std] * 2
+
+    # Accumulate the mean and the squared deviations of the outputs as they 
+    # arrive (Welford's algorithm), so the replications are never stored.
+    boot_mean = np.zeros(sum(sizes))
+    boot_m2 = np.zeros(sum(sizes))
+
+    shm_boot, boot_spec = share_array(shs_boot)
+    shm_resampling, resampling_spec = share_array(resampling)
+    ncpu = os.cpu_count()
+    try:
+        with Pool(processes=ncpu, 
+                  maxtasksperchild=2, # A task is a chunk of replications
+                  initializer=bootstrap_init, 
+                  initargs=(boot_spec, resampling_spec, 
+                            lasso_selec, lasso_l, lasso_u)) as pool:
+            for i, result in enumerate(tqdm(
+                pool.imap_unordered(bootstrap_star, 
+                                    range(REP), 
+                                    chunksize=max(1, REP // (4*ncpu))), 
+                total=REP
+                ), start=1):
+                delta = result - boot_mean
+                boot_mean += delta / i
+                boot_m2 += delta * (result - boot_mean)
+    finally:
+        for shm in (shm_boot, shm_resampling):
+            shm.close()
+            shm.unlink()
+
+
+    # Calculate bootstrap standard errors, with the divisor REP of np.std.
+    (cov_se, cov_pd_se, cor_se, std_se, std_scale_s_se, std_scale_sm_se, 
+     std_scale_sf_se, std_l_se, std_u_se) = np.split(
+        np.sqrt(boot_m2 / REP), np.cumsum(sizes)[:-1]
         )
-    cov_pd_store = np.zeros(
-        (REP, int((len(SHAREABLE)*(len(SHAREABLE)+1)/2)*len(TYPE)))
-        )
-    cor_store = np.zeros(
-        (REP, int((len(SHAREABLE)*(len(SHAREABLE)+1)/2)*len(TYPE)))
-        )
-    std_store = np.zeros((REP, int(len(SHAREABLE)*len(TYPE))))
-    std_scale_s_store = np.zeros((REP, int(len(TYPE))))
-    std_scale_sm_store = np.zeros((REP, int(len(TYPE))))
-    std_scale_sf_store = np.zeros((REP, int(len(TYPE))))
-    std_l_store = np.zeros((REP, int(len(SHAREABLE)*len(TYPE))))
-    std_u_store = np.zeros((REP, int(len(SHAREABLE)*len(TYPE))))
-
-    for i in range(REP):
-        cov_store[i, :] = results_store[i][0].to_numpy()
-        cov_pd_store[i, :] = results_store[i][1].to_numpy()
-        cor_store[i, :] = results_store[i][2].to_numpy()
-        std_store[i, :] = results_store[i][3].to_numpy()
-        std_scale_s_store[i, :] = results_store[i][4]
-        std_scale_sm_store[i, :] = results_store[i][5]
-        std_scale_sf_store[i, :] = results_store[i][6]
-        std_l_store[i, :] = results_store[i][7].to_numpy()
-        std_u_store[i, :] = results_store[i][8].to_numpy()
-
-    
-    # Calculate bootstrap standard errors.
-    cov_se = np.std(cov_store, axis=0)
-    cov_pd_se = np.std(cov_pd_store, axis=0)
-    cor_se = np.std(cor_store, axis=0)
 
     cov_matrix_se = np.zeros((len(SHAREABLE), len(SHAREABLE), len(TYPE)))
     cov_matrix_pd_se = np.zeros((len(SHAREABLE), len(SHAREABLE), len(TYPE)))
     cor_matrix_se = np.zeros((len(SHAREABLE), len(SHAREABLE), len(TYPE)))
 
-    for i in range(len(TYPE)):
-        idx = results_store[0][0].index.str.contains(f"h{i+1}")
-
-        cov_matrix_se[:, :, i][
-            np.triu_indices_from(cov_matrix_se[:, :, i], k=0)
-            ] = cov_se[idx]
-        cov_matrix_se[:, :, i][
-            np.tril_indices_from(cov_matrix_se[:, :, i], k=-1)
-            ] = cov_matrix_se[:, :, i].T[
-                np.tril_indices_from(cov_matrix_se[:, :, i], k=-1)
-                ]
-        
-        cov_matrix_pd_se[:, :, i][
-            np.triu_indices_from(cov_matrix_pd_se[:, :, i], k=0)
-            ] = cov_pd_se[idx]
-        cov_matrix_pd_se[:, :, i][
-            np.tril_indices_from(cov_matrix_pd_se[:, :, i], k=-1)
-            ] = cov_matrix_pd_se[:, :, i].T[
-                np.tril_indices_from(cov_matrix_pd_se[:, :, i], k=-1)
-                ]
-
-        cor_matrix_se[:, :, i][
-            np.triu_indices_from(cor_matrix_se[:, :, i], k=0)
-            ] = cor_se[idx]
-        cor_matrix_se[:, :, i][
-            np.tril_indices_from(cor_matrix_se[:, :, i], k=-1)
-            ] = cor_matrix_se[:, :, i].T[
-                np.tril_indices_from(cor_matrix_se[:, :, i], k=-1)
-                ]
-
-    std_se_df = pd.DataFrame(
-        np.std(std_store, axis=0).reshape([len(TYPE), len(SHAREABLE)]).T, 
-        index=NAME_w, 
-        columns=[f'std.se.h{i}' for i in range(len(TYPE))], 
-        dtype=float
-        )
-    std_se_l_df = pd.DataFrame(
-        np.std(std_l_store, axis=0).reshape([len(TYPE), len(SHAREABLE)]).T, 
-        index=NAME_w, 
-        columns=[f'std.se.lower.h{i}' for i in range(len(TYPE))], 
-        dtype=float
-        )
-    std_se_u_df = pd.DataFrame(
-        np.std(std_u_store, axis=0).reshape([len(TYPE), len(SHAREABLE)]).T, 
+    # The covariance outputs run over the (iu, ju) cross-products within each 
+    # type. Scatter them into the upper triangles of all types at once, then 
+    # add the transpose and halve the doubled diagonal.
+    type_id = np.repeat(np.arange(len(TYPE)), len(NAME_bery_crossprod))
+    rows, cols = np.tile(iu, len(TYPE)), np.tile(ju, len(TYPE))
+
+    for matrix_se, se in ((cov_matrix_se, cov_se), 
+                          (cov_matrix_pd_se, cov_pd_se), 
+                          (cor_matrix_se, cor_se)):
+        matrix_se[rows, cols, type_id] = se
+        matrix_se += matrix_se.transpose(1, 0, 2)
+        matrix_se[np.diag_indices(len(SHAREABLE))] /= 2
+
+    # Build the standard deviation SEs of the baseline and both LASSO 
+    # penalties in one frame, with one block of type columns for each.
+    std_se_all = pd.DataFrame(
+        np.stack([std_se, std_l_se, std_u_se]).reshape(-1, len(SHAREABLE)).T, 
         index=NAME_w, 
-        columns=[f'std.se.upper.h{i}' for i in range(len(TYPE))], 
-        dtype=float
+        columns=[f'std.se.{penalty}h{i}' 
+                 for penalty in ('', 'lower.', 'upper.') 
+                 for i in range(len(TYPE))]
         )
+    std_se_df, std_se_l_df, std_se_u_df = [
+        std_se_all.iloc[:, k*len(TYPE):(k+1)*len(TYPE)] for k in range(3)
+        ]
 
-    std_scale_se_s = pd.DataFrame(
-        np.std(std_scale_s_store, axis=0).reshape([1, len(TYPE)]), 
-        index=['s'], 
-        columns=[f'scale.std.se.h{i}' for i in range(len(TYPE))], 
-        dtype=float
-        )
-    std_scale_se_sm = pd.DataFrame(
-        np.std(std_scale_sm_store, axis=0).reshape([1, len(TYPE)]), 
-        index=['sm'], 
-        columns=[f'scale.std.se.h{i}' for i in range(len(TYPE))], 
-        dtype=float
+    std_scale_se = pd.DataFrame(
+        np.stack([std_scale_s_se, std_scale_sm_se, std_scale_sf_se]), 
+        index=['s', 'sm', 'sf'], 
+        columns=[f'scale.std.se.h{i}' for i in range(len(TYPE))]
         )
-    std_scale_se_sf = pd.DataFrame(
-        np.std(std_scale_sf_store, axis=0).reshape([1, len(TYPE)]), 
-        index=['sf'], 
-        columns=[f'scale.std.se.h{i}' for i in range(len(TYPE))], 
-        dtype=float
-        )
-
+    std_scale_se_s, std_scale_se_sm, std_scale_se_sf = [
+        std_scale_se.loc[[single]] for single in std_scale_se.index
+        ]
 
     # Print results.
     print("covariance matrix standard errors, unadjusted")
@@ -1004,19 +1000,19 @@ if __name__ == '__main__':
         print(cor_matrix_se[:, :, i])
 
     print("standard deviation standard errors")
-    print(std_se_df.astype(float).round(4))
+    print(std_se_df.to_string(float_format='{:.4f}'.format))
 
     print("LASSO robustness check, 0.5*penalty")
-    print(std_se_l_df.astype(float).round(4))
+    print(std_se_l_df.to_string(float_format='{:.4f}'.format))
 
     print("LASSO robustness check, 2*penalty")
-    print(std_se_u_df.astype(float).round(4))
+    print(std_se_u_df.to_string(float_format='{:.4f}'.format))
 
     print("scale index standard deviation standard errors, singles")
-    print(std_scale_se_s.astype(float).round(4))
+    print(std_scale_se_s.to_string(float_format='{:.4f}'.format))
 
     print("scale index standard deviation standard errors, single males")
-    print(std_scale_se_sm.astype(float).round(4))
+    print(std_scale_se_sm.to_string(float_format='{:.4f}'.format))
 
     print("scale index standard deviation standard errors, singles females")
-    print(std_scale_se_sf.astype(float).round(4))
+    print(std_scale_se_sf.to_string(float_format='{:.4f}'.format))